@@ -1,94 +1,281 @@
+import hashlib
+import os
+import pickle
+import tempfile
 import pandas as pd
-import networkx as nx
+import threading
+from collections import OrderedDict, defaultdict
+import scipy.sparse as sp
 from typing import Optional
+from datetime import timedelta
 from tqdm import tqdm
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests_cache import CachedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from scipy.stats import hypergeom
-from statsmodels.stats.multitest import multipletests
+
+def _bh(p):
+    """Benjamini–Hochberg adjusted p-values (same as multipletests 'fdr_bh').
+
+    Adjusts along the last axis, so a 2-D array is corrected row by row.
+    """
+    p = np.asarray(p, dtype=float)
+    m = p.shape[-1]
+    order = np.argsort(p, axis=-1)
+    ranked = np.take_along_axis(p, order, axis=-1) * m / np.arange(1, m + 1)
+    q = np.minimum.accumulate(ranked[..., ::-1], axis=-1)[..., ::-1]
+    out = np.empty_like(q)
+    np.put_along_axis(out, order, np.clip(q, 0, 1), axis=-1)
+    return out
 
 class FunctionalEnrichment:
+    # bump when the pickled attribute layout changes (see functional_enrichment)
+    CACHE_VERSION = 1
+    DEFAULT_CATEGORIES = (
+        'Biological Process (Gene Ontology)',
+        'Reactome Pathways'
+    )
+
     def __init__(
             self, 
             mapping_file: str, 
-            categories=(
-                'Biological Process (Gene Ontology)',
-                'Reactome Pathways'
-        )):
-        # cols: protein_id, term_id, category, description
-        df = pd.read_csv(mapping_file, sep='\t', header=None, comment='#',
-                         names=['protein','category','term','description'])
-        df["category"] = df["category"].str.strip()
-        df = df[df['category'].isin(categories)]
+            categories=DEFAULT_CATEGORIES
+        ):
+        self.categories = tuple(categories)
+        # cols: protein_id, category, term_id, description
+        # parse with Arrow and drop unused categories before building pandas
+        # objects, as the STRING terms file holds millions of rows
+        table = pacsv.read_csv(
+            mapping_file,
+            read_options=pacsv.ReadOptions(
+                column_names=['protein','category','term','description'],
+                skip_rows=1,  # '#string_protein_id ...' header
+            ),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(
+                column_types={
+                    'protein': pa.string(), 'category': pa.string(),
+                    'term': pa.string(), 'description': pa.string(),
+                },
+            ),
+        )
+        category = pc.utf8_trim_whitespace(table['category'])
+        table = table.set_column(1, 'category', category).filter(
+            pc.is_in(category, value_set=pa.array(categories, pa.string()))
+        )
+        df = table.to_pandas()
         self.description = df.set_index('term')['description'].to_dict()
-        # build cat → term → set(genes) dictionary
-        pivot = (
-            df.groupby(['category', 'term'])
-              .agg({'protein': lambda x: set(x)})
-              .unstack(level=0)['protein']      # columns = categories
+        # build cat → term → frozenset(genes) dictionary
+        self.cat2term2genes = defaultdict(dict)
+        for (cat, term), proteins in df.groupby(['category', 'term'], sort=False)['protein']:
+            self.cat2term2genes[cat][term] = frozenset(proteins.values)
+        # background universe is every protein appearing in any term
+        self.background = frozenset(df['protein'].unique())
+        # flatten cat → term → genes into parallel per-term arrays so that
+        # enrich can test every term with a single vectorized hypergeom call
+        flat = [
+            (cat, term, genes)
+            for cat, t2g in self.cat2term2genes.items()
+            for term, genes in t2g.items()
+        ]
+        self.term_categories = np.array([cat for cat, _, _ in flat], dtype=object)
+        self.term_arr = np.array([term for _, term, _ in flat], dtype=object)
+        self.term_descriptions = np.array(
+            [self.description.get(term) for term in self.term_arr], dtype=object
+        )
+        self.term_genes = [genes for _, _, genes in flat]
+        self.term_sizes = np.array(
+            [len(genes) for genes in self.term_genes], dtype=np.int64
         )
-        self.cat2term2genes = {
-            cat: pivot[cat].dropna().to_dict()  # NaN rows = term with zero genes
-            for cat in pivot.columns
+        # inverted index gene → term indices, so overlaps become a bincount
+        gene2terms = defaultdict(list)
+        for term_ix, genes in enumerate(self.term_genes):
+            for gene in genes:
+                gene2terms[gene].append(term_ix)
+        self.gene2terms = {
+            gene: np.array(ixs, dtype=np.int32)
+            for gene, ixs in gene2terms.items()
         }
-        # background universe is every protein appearing in any term
-        self.background = set(df['protein'].unique())
 
-    def _hyper(self, term_genes, study_genes):
+    def enrich(self, study_genes, fdr_cut=0.05):
+        return self.enrich_many([study_genes], fdr_cut=fdr_cut)[0]
+
+    def enrich_many(self, study_sets, fdr_cut=0.05):
+        """Enrich several study gene sets (e.g. clusters) in one pass."""
+        study_sets = [self.background.intersection(genes) for genes in study_sets]
+        n_sets = len(study_sets)
+        n_terms = len(self.term_genes)
         N = len(self.background)
-        M = len(term_genes)
-        n = len(study_genes)
-        K = len(term_genes & study_genes)
-        # sf = P(X ≥ K)
-        return hypergeom.sf(K-1, N, M, n) if K else 1.0
+        # offset each set's term indices so one bincount covers every set
+        hits = [
+            self.gene2terms[g] + i * n_terms
+            for i, genes in enumerate(study_sets) for g in genes
+        ]
+        overlaps = np.bincount(
+            np.concatenate(hits) if hits else np.empty(0, dtype=np.int32),
+            minlength=n_sets * n_terms
+        ).astype(np.int64).reshape(n_sets, n_terms)
+        study_sizes = np.array([len(genes) for genes in study_sets], dtype=np.int64)
+        # sf = P(X ≥ K), evaluated for all (set, term) pairs at once
+        p = np.where(
+            overlaps > 0,
+            hypergeom.sf(overlaps - 1, N, self.term_sizes, study_sizes[:, None]),
+            1.0
+        )
+        fdr = _bh(p)
+        return [
+            self._results(genes, overlaps[i], p[i], fdr[i], fdr_cut)
+            for i, genes in enumerate(study_sets)
+        ]
 
-    def enrich(self, study_genes, fdr_cut=0.05):
-        study_genes = set(study_genes) & self.background
-        records = []
-        for cat, t2g in self.cat2term2genes.items():
-            for term, genes in t2g.items():
-                p = self._hyper(genes, study_genes)
-                records.append((cat, term, p, len(genes & study_genes),
-                                len(genes), len(study_genes), list(study_genes)))
-        out = pd.DataFrame(records, columns=[
-            'category','term', 'p','overlap',
-            'term_size','study_size', 'inputGenes'
-        ])
-
-        if out.empty:
-            return out
-
-        # Map descriptions
-        out["description"] = out['term'].map(self.description)
-
-        out['fdr'] = multipletests(out.p, method='fdr_bh')[1]
-        out = out[out.fdr <= fdr_cut].copy()
-        return out.sort_values('fdr').reset_index(drop=True)
-
-def compute_prior_away(score: float, prior: float = 0.041):
-    if score < prior:
-        score = prior
+    def _results(self, study_genes, overlaps, p, fdr, fdr_cut):
+        # only materialize the terms that pass the cutoff
+        keep = np.flatnonzero(fdr <= fdr_cut)
+        out = pd.DataFrame({
+            'category': self.term_categories[keep],
+            'term': self.term_arr[keep],
+            'p': p[keep],
+            'overlap': overlaps[keep],
+            'term_size': self.term_sizes[keep],
+            'study_size': len(study_genes),
+            'description': self.term_descriptions[keep],
+            'fdr': fdr[keep],
+        })
+        out = out.sort_values('fdr').reset_index(drop=True)
+        # the study genes are shared by every term: store them once
+        out.attrs['inputGenes'] = sorted(study_genes)
+        return out
+
+def compute_prior_away(score, prior: float = 0.041):
+    score = np.maximum(score, prior)
     return (score - prior) / (1 - prior)
 
 def combine_scores(subscores, prior=0.041):
+    # subscores: one edge's sub-scores, or an (n_edges, n_sources) array
     # Remove prior
-    corrected = [compute_prior_away(s, prior) for s in subscores]
-    
-    # Combine using 1 - Π(1 - score)
-    combined_no_prior = 1.0
-    for s in corrected:
-        combined_no_prior *= (1.0 - s)
+    corrected = compute_prior_away(np.asarray(subscores, dtype=float), prior)
+
+    # Combine using 1 - Π(1 - score) across sources
+    combined_no_prior = np.prod(1.0 - corrected, axis=-1)
     combined = (1.0 - combined_no_prior)
-    
+
     # Add prior back
     combined = combined * (1.0 - prior) + prior
     return combined
 
 
+def _normalize_columns(matrix):
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    return (matrix @ sp.diags(1.0 / sums)).tocsc()
+
+def _mcl(matrix, inflation, expansion=2, iterations=100, pruning_threshold=0.001):
+    """Markov clustering of a sparse adjacency matrix.
+
+    Same procedure and defaults as markov_clustering.run_mcl (unit self-loops,
+    column normalisation, pruning that keeps each column's maximum), using
+    vectorized sparse ops in place of its per-element DOK updates.
+    """
+    n = matrix.shape[0]
+    matrix = sp.csc_matrix(matrix, dtype=float)
+    matrix = matrix - sp.diags(matrix.diagonal()) + sp.eye(n)
+    matrix = _normalize_columns(matrix)
+    for _ in range(iterations):
+        last = matrix
+        # expansion
+        for _ in range(expansion - 1):
+            matrix = matrix @ last
+        # inflation
+        matrix = _normalize_columns(matrix.power(inflation))
+        # prune small entries, always keeping each column's maximum
+        matrix.sort_indices()
+        cols = np.repeat(np.arange(n), np.diff(matrix.indptr))
+        col_max = np.asarray(matrix.argmax(axis=0)).ravel()
+        keep = (matrix.data >= pruning_threshold) | (matrix.indices == col_max[cols])
+        matrix.data[~keep] = 0
+        matrix.eliminate_zeros()
+        # converged when allclose(matrix, last)
+        if (abs(matrix - last) - 1e-5 * abs(last)).max() <= 1e-8:
+            break
+    return matrix
+
+def _mcl_clusters(matrix):
+    # nodes sharing a row with an attractor (non-zero diagonal) form a cluster
+    matrix = sp.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    clusters = {
+        tuple(matrix.indices[matrix.indptr[a]:matrix.indptr[a + 1]].tolist())
+        for a in matrix.diagonal().nonzero()[0]
+    }
+    return sorted(clusters)
+
+
+def _load_enrichment_cache(cache_path: str, mapping_file: str, categories: tuple):
+    # None when the pickle is missing, older than the terms file, unreadable,
+    # or written for another FunctionalEnrichment layout or category set
+    try:
+        if os.path.getmtime(cache_path) < os.path.getmtime(mapping_file):
+            return None
+        with open(cache_path, "rb") as f:
+            payload = pickle.load(f)
+    except Exception:
+        return None
+    if (not isinstance(payload, dict)
+            or payload.get("version") != FunctionalEnrichment.CACHE_VERSION
+            or payload.get("categories") != categories):
+        return None
+    return payload["enrichment"]
+
+def functional_enrichment(
+        mapping_file: str,
+        categories=FunctionalEnrichment.DEFAULT_CATEGORIES
+    ):
+    # normalize before the lru_cache, which needs hashable arguments
+    return _cached_functional_enrichment(mapping_file, tuple(categories))
+
 from functools import lru_cache
 @lru_cache(maxsize=1)
-def functional_enrichment(mapping_file: str):
-    return FunctionalEnrichment(mapping_file)
+def _cached_functional_enrichment(mapping_file: str, categories: tuple):
+    # Reuse the index pickled next to the terms file when it is still valid;
+    # each category set gets its own pickle
+    digest = hashlib.sha1("\n".join(categories).encode()).hexdigest()[:8]
+    cache_path = f"{mapping_file}.{digest}.pkl"
+    enrichment = _load_enrichment_cache(cache_path, mapping_file, categories)
+    if enrichment is not None:
+        return enrichment
+
+    enrichment = FunctionalEnrichment(mapping_file, categories=categories)
+    payload = {
+        "version": FunctionalEnrichment.CACHE_VERSION,
+        "categories": categories,
+        "enrichment": enrichment,
+    }
+    tmp_path = None
+    try:
+        # unique temp file in the target directory, so concurrent builders
+        # never share a file and os.replace publishes a complete pickle
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_path) or ".",
+                suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # the cache is an optimisation only: serve the freshly built index
+        print(f"Warning: could not write enrichment cache {cache_path}: {e}")
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return enrichment
 
 class StringAPI:
     EDGE_SOURCES = {
@@ -100,6 +287,47 @@ class StringAPI:
         "database": "dscore",
         "textmining": "tscore"
     }
+    # get_interactions results kept per instance (most recently used)
+    INTERACTIONS_CACHE_SIZE = 4
+    # Shared across instances so STRING connections are kept alive and reused.
+    # Responses are deterministic for a pinned API version, so they are also
+    # cached on disk (keyed on the POST body) and replayed across runs.
+    # Created on first use (see _get_session), not at import time.
+    CACHE_PATH = os.environ.get(
+        "STRING_CACHE_PATH",
+        os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            ".string_cache.sqlite"
+        )
+    )
+    _session = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def _get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                session = CachedSession(
+                    cls.CACHE_PATH,
+                    allowable_methods=("GET", "POST"),
+                    expire_after=timedelta(days=30),
+                    match_headers=False,
+                )
+                session.mount("https://", HTTPAdapter(
+                    pool_connections=10,
+                    pool_maxsize=20,
+                    # STRING endpoints are idempotent queries: retry POSTs and
+                    # transient server / rate-limit responses too
+                    max_retries=Retry(
+                        total=3,
+                        backoff_factor=0.3,
+                        allowed_methods=None,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                    )
+                ))
+                cls._session = session
+        return cls._session
+
     def __init__(
             self, 
             species: int,
@@ -113,10 +341,10 @@ class StringAPI:
         self.api_url = api_url
         self.caller_identity = caller_identity
         if identifiers:
-            self.gene_ids = list(set(identifiers))
+            self.gene_ids = sorted(set(identifiers))
             self.genes = self.gene_ids
         elif genes:
-            self.genes = list(set(genes))
+            self.genes = sorted(set(genes))
             self.identifiers = self.get_identifiers()
 
             if self.identifiers.empty:
@@ -128,7 +356,7 @@ class StringAPI:
                 print(f"{self.identifiers.string_identifier.nunique()} unique STRING identifiers.")
                 print("Warning: Some genes have multiple STRING identifiers. This may affect downstream analyses.")
             
-            self.gene_ids = self.identifiers.string_identifier.unique().tolist()
+            self.gene_ids = sorted(self.identifiers.string_identifier.unique().tolist())
         else:
             raise ValueError("Must provide either genes or identifiers")
 
@@ -137,6 +365,11 @@ class StringAPI:
                 mapping_file=functional_enrichment_file
             )
 
+        # small LRU of get_interactions results, keyed on
+        # (confidence, excluded sources); both come from the client
+        self._interactions = OrderedDict()
+        self._interactions_lock = threading.Lock()
+
     def get_identifiers(self):
         output_format = "tsv-no-header"
         method = "get_string_ids"
@@ -165,7 +398,7 @@ class StringAPI:
         ## Call STRING
         ##
 
-        results = requests.post(request_url, data=params)
+        results = self._get_session().post(request_url, data=params, timeout=30)
 
         ##
         ## Read and parse the results
@@ -214,7 +447,7 @@ class StringAPI:
         ## Call STRING
         ##
 
-        response = requests.post(request_url, data=params)
+        response = self._get_session().post(request_url, data=params, timeout=30)
 
         ##
         ## Parse and print the respons Parse and print the responsee
@@ -229,7 +462,20 @@ class StringAPI:
             confidence: float = 0.4, 
             exclude: set = set(),
         ):
-
+        key = (confidence, frozenset(exclude or ()))
+        with self._interactions_lock:
+            if key in self._interactions:
+                self._interactions.move_to_end(key)
+                return self._interactions[key]
+
+        interactions = self._fetch_interactions(*key)
+        with self._interactions_lock:
+            self._interactions[key] = interactions
+            while len(self._interactions) > self.INTERACTIONS_CACHE_SIZE:
+                self._interactions.popitem(last=False)
+        return interactions
+
+    def _fetch_interactions(self, confidence: float, exclude: frozenset):
         output_format = "json"
         method = "network"
         request_url = "/".join([self.api_url, output_format, method])
@@ -241,54 +487,55 @@ class StringAPI:
             "caller_identity": self.caller_identity
         }
 
-        response = requests.post(request_url, data=params)
-        data = response.json()
+        response = self._get_session().post(request_url, data=params, timeout=30)
+        data = orjson.loads(response.content)
 
-        final_interactions = []
         prior = 0.041
         exclude = {self.EDGE_SOURCES[k] for k in exclude} if exclude else set()
+        sources = [k for k in self.EDGE_SOURCES.values() if k not in exclude]
 
-        for entry in data:
-            # Extract sub-scores and divide by 1000 to match [0,1] scale
-            scores = {
-                "nscore": entry.get("nscore", 0),
-                "fscore": entry.get("fscore", 0),
-                "pscore": entry.get("pscore", 0),
-                "ascore": entry.get("ascore", 0),
-                "escore": entry.get("escore", 0),
-                "dscore": entry.get("dscore", 0),
-                "tscore": entry.get("tscore", 0),
-            }
-
-            subscores = [
-                v for k, v in scores.items() if k not in exclude
-            ]
-
-            recombined = combine_scores(subscores, prior)
-
-            if recombined >= confidence:
-                entry["recomputed_score"] = recombined
+        # (n_edges, n_sources) sub-score matrix, scored in one vectorized pass
+        scores = np.array(
+            [[entry.get(k, 0) for k in sources] for entry in data],
+            dtype=float
+        ).reshape(len(data), len(sources))
+        recombined = combine_scores(scores, prior)
+        keep = recombined >= confidence
+
+        final_interactions = []
+        for entry, score, kept in zip(data, recombined.tolist(), keep):
+            if kept:
+                entry["recomputed_score"] = score
                 final_interactions.append(entry)
 
         return final_interactions
 
     def build_network(self, interactions):
-        G = nx.Graph()
-
-        data = [
-            (entry["stringId_A"], entry["stringId_B"], entry["recomputed_score"])
-            for entry in interactions
-        ]
-        G.add_weighted_edges_from(data)
-        return G
+        # Symmetric weighted adjacency as CSR, plus the node name of each index
+        index = {}
+        edges = {}
+        for entry in interactions:
+            a = index.setdefault(entry["stringId_A"], len(index))
+            b = index.setdefault(entry["stringId_B"], len(index))
+            # a repeated pair (either direction) overwrites the earlier weight,
+            # as nx.Graph.add_weighted_edges_from did, instead of summing
+            edges[(a, b) if a <= b else (b, a)] = entry["recomputed_score"]
+        rows, cols, weights = [], [], []
+        for (a, b), weight in edges.items():
+            rows.append(a)
+            cols.append(b)
+            weights.append(weight)
+            if a != b:
+                rows.append(b)
+                cols.append(a)
+                weights.append(weight)
+        n = len(index)
+        matrix = sp.csr_matrix((weights, (rows, cols)), shape=(n, n))
+        return matrix, list(index)
 
     def mcl_clustering(self, network, inflation: float = 3, min_cluster_size: int = 2):
-        import markov_clustering as mc
-        import scipy.sparse as sp
-
-        matrix = nx.to_scipy_sparse_array(network)
-        result = mc.run_mcl(sp.csr_matrix(matrix), inflation=inflation, verbose=False)
-        clusters = mc.get_clusters(result)
+        matrix, nodes = network
+        clusters = _mcl_clusters(_mcl(matrix, inflation=inflation))
 
         # Filter clusters by minimum size
         clusters = [c for c in clusters if len(c) >= min_cluster_size]
@@ -296,9 +543,6 @@ class StringAPI:
         # Sort clusters by descending size
         sorted_clusters = sorted(clusters, key=lambda x: -len(x))  # Largest first
 
-        # Map node index → preferred name using graph
-        nodes = list(network.nodes())
-
         # Create mapping
         name_to_cluster = {}
         for cluster_id, cluster in enumerate(sorted_clusters):
@@ -306,8 +550,6 @@ class StringAPI:
                 name = nodes[node_index]
                 name_to_cluster[name] = cluster_id
 
-        from collections import defaultdict
-
         clusters = defaultdict(list)
         for name, cid in name_to_cluster.items():
             clusters[cid].append(name)
@@ -340,7 +582,7 @@ class StringAPI:
 
         params = {
 
-            "identifiers" : "%0d".join(genes), # your protein
+            "identifiers" : "%0d".join(sorted(genes)), # your protein (sorted: stable cache key)
             "species" : self.species, # NCBI/STRING taxon identifier 
             "caller_identity" : self.caller_identity # your app name
 
@@ -350,13 +592,13 @@ class StringAPI:
         ## Call STRING
         ##
 
-        response = requests.post(request_url, data=params)
+        response = self._get_session().post(request_url, data=params, timeout=30)
 
         ##
         ## Read and parse the results
         ##
 
-        data = response.json()
+        data = orjson.loads(response.content)
         results = pd.DataFrame.from_dict(data)
         try:
             results = results[results["fdr"] <= fdr].copy()
@@ -373,13 +615,31 @@ class StringAPI:
         ) -> pd.DataFrame:
 
         enrichment_results = []
+        input_genes = {}
         # string_to_name = self.identifiers.set_index("string_identifier")["input_identifier"].to_dict()
-        for cluster_id, cluster_genes in tqdm(clusters.items()):
-            if len(cluster_genes) < min_cluster_size:
-                continue
-
-            enrichment = self.functional_enrichment(cluster_genes, fdr=fdr)
+        clusters = {
+            cluster_id: cluster_genes
+            for cluster_id, cluster_genes in clusters.items()
+            if len(cluster_genes) >= min_cluster_size
+        }
 
+        if hasattr(self, "_functional_enrichment"):
+            # local enrichment: every cluster in a single vectorized pass
+            results = self._functional_enrichment.enrich_many(
+                list(clusters.values()), fdr_cut=fdr
+            )
+        else:
+            # STRING API: one request per cluster, issued concurrently
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(tqdm(
+                    pool.map(
+                        lambda genes: self.functional_enrichment(genes, fdr=fdr),
+                        clusters.values()
+                    ),
+                    total=len(clusters)
+                ))
+
+        for (cluster_id, cluster_genes), enrichment in zip(clusters.items(), results):
             if enrichment.empty:
                 continue
 
@@ -388,27 +648,36 @@ class StringAPI:
             # cluster_genes = [string_to_name.get(g, g) for g in cluster_genes]
             enrichment["cluster_genes"] = len(enrichment) * [cluster_genes]
             enrichment_results.append(enrichment)
+            if "inputGenes" in enrichment.attrs:
+                input_genes[cluster_id] = enrichment.attrs["inputGenes"]
 
-        return pd.concat(enrichment_results)
+        enrichment = pd.concat(enrichment_results)
+        # local enrichment keeps one input gene list per cluster, not per term
+        enrichment.attrs["inputGenes"] = input_genes
+        return enrichment
 
     def get_top_enrichment(
             self, 
             enrichment: pd.DataFrame,
             top_k: int = 2,
         ):
-        top_enrichment = []
-        for _, group in enrichment.groupby("cluster"):
-            group.sort_values("fdr", inplace=True)
-            gobp = group[group["category"].str.contains("Process")].copy()
-            gobp["category"] = "GOBP"
-            kegg = group[group["category"].str.contains("KEGG")].copy()
-            kegg["category"] = "KEGG"
-            reactome = group[
-                (group["category"].str.contains("RCTM")) |
-                (group["category"].str.contains("Reactome"))
-            ].copy()
-            reactome["category"] = "RCTM"
-            top_enrichment.append(pd.concat([
-                gobp.head(top_k), kegg.head(top_k), reactome.head(top_k)
-            ]))
-        return pd.concat(top_enrichment).reset_index(drop=True)
+        # bucket every row once, then take the top_k per (cluster, bucket)
+        category = enrichment["category"].str
+        bucket = np.select(
+            [
+                category.contains("Process", na=False),
+                category.contains("KEGG", na=False),
+                category.contains("RCTM|Reactome", na=False),
+            ],
+            ["GOBP", "KEGG", "RCTM"],
+            default="",
+        )
+        top_enrichment = enrichment.assign(category=bucket)
+        top_enrichment = top_enrichment[top_enrichment["category"] != ""]
+        return (
+            top_enrichment
+              .sort_values(["cluster", "category", "fdr"])
+              .groupby(["cluster", "category"], sort=False)
+              .head(top_k)
+              .reset_index(drop=True)
+        )
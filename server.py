@@ -1,6 +1,8 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 import json
+from functools import lru_cache
+import orjson
 import pandas as pd
 
 from api.stringdb import StringAPI
@@ -49,6 +51,20 @@ grouped_modifiers = format_modifiers(pd.read_csv("data/modifiers.csv"))
 celltype_modifiers = format_modifiers(pd.read_csv("data/celltype-modifiers.csv"))
 print(celltype_modifiers)
 
+def values_by_id(modifiers: pd.DataFrame, column: str):
+    """Map each string_id to the unique values of `column` for that gene."""
+    return modifiers.groupby("string_id")[column].unique().apply(list).to_dict()
+
+# Per-gene node annotations, computed once rather than on every request
+SOURCE_BY_ID = {
+    "celltype": values_by_id(celltype_modifiers, "disease"),
+    "grouped": values_by_id(grouped_modifiers, "disease"),
+}
+EFFECT_BY_ID = {
+    "celltype": values_by_id(celltype_modifiers, "modifier_type"),
+    "grouped": values_by_id(grouped_modifiers, "modifier_type"),
+}
+
 
 def filter_modifiers(modifiers, analyses=None, effect=None):
     """Filter modifiers based on analyses and effect."""
@@ -58,6 +74,15 @@ def filter_modifiers(modifiers, analyses=None, effect=None):
         modifiers = modifiers[modifiers['effect'].isin(effect)]
     return modifiers
 
+@lru_cache(maxsize=64)
+def get_string_api(species: int, identifiers: tuple, enrichment_file: str):
+    """StringAPI per (species, gene set), reused across identical requests."""
+    return StringAPI(
+        species = species,
+        identifiers = list(identifiers),
+        functional_enrichment_file = enrichment_file,
+    )
+
 @app.route('/api/graph-data', methods=['POST'])
 def graph_data():
     """Return nodes / edges / enrichment with user-defined filters."""
@@ -69,12 +94,13 @@ def graph_data():
     include_src = set(cfg.get('edgeSources', EDGE_SOURCES))
     exclude_src = EDGE_SOURCES - include_src                 # pass to STRING API
 
+    statistic = "celltype" if statistic == "celltype" else "grouped"
     modifiers = celltype_modifiers if statistic == "celltype" else grouped_modifiers
     df = filter_modifiers(modifiers, analyses=analyses, effect=effect)
-    string = StringAPI(
-        species = SPECIES,
-        identifiers = df.string_id.unique().tolist(),
-        functional_enrichment_file = f"data/{SPECIES}.protein.enrichment.terms.v12.0.txt",
+    string = get_string_api(
+        SPECIES,
+        tuple(sorted(df.string_id.unique())),
+        f"data/{SPECIES}.protein.enrichment.terms.v12.0.txt",
     )
     interactions = string.get_interactions(
         exclude=exclude_src, 
@@ -86,7 +112,11 @@ def graph_data():
     clusters, name_to_cluster = string.mcl_clustering(network, inflation=2)
     enrichment = string.mcl_functional_enrichment(clusters, fdr=0.05)
     top_enrichment = string.get_top_enrichment(enrichment)
-    top_clusters = top_enrichment["cluster"].unique().tolist()
+    if "inputGenes" not in top_enrichment:
+        top_enrichment["inputGenes"] = top_enrichment["cluster"].map(
+            enrichment.attrs["inputGenes"]
+        )
+    top_clusters = set(top_enrichment["cluster"].unique().tolist())
     top_enrichment["source"] = top_enrichment["category"].map({
         "KEGG": "KEGG",
         "RCTM": "Reactome Pathways",
@@ -94,50 +124,63 @@ def graph_data():
         "Biological Process (Gene Ontology)": "Biological Process (Gene Ontology)",
         "Reactome Pathways": "Reactome Pathways"
     })
+    rows = top_enrichment[
+        ["cluster", "term", "description", "fdr", "source", "inputGenes"]
+    ].itertuples(index=False, name=None)
     enrichment = [
         {
-            "cluster": row["cluster"], 
-            "pathwayId": row["term"], 
-            "pathway": row["description"], 
-            "fdr": row["fdr"],
-            "source": row["source"],
-            "genes": row["inputGenes"],
+            "cluster": cluster,
+            "pathwayId": term,
+            "pathway": description,
+            "fdr": fdr,
+            "source": source,
+            "genes": genes,
         }
-        for _, row in top_enrichment.iterrows() if row["cluster"] in top_clusters
+        for cluster, term, description, fdr, source, genes in rows
+        if cluster in top_clusters
     ]
     name_to_cluster = { 
         k: v for k, v in name_to_cluster.items() if v in top_clusters 
     }
 
-    source = modifiers.groupby("string_id")["disease"].unique()
-    effect = modifiers.groupby("string_id")["modifier_type"].unique()
-    
+    source = SOURCE_BY_ID[statistic]
+    effect = EFFECT_BY_ID[statistic]
+
     nodes = [
         { "data": {
             "id": node_id,
             "name": gene_data[node_id]["name"],
             "cluster": cluster_id,
-            "source": source[node_id].tolist(),
-            "effect": effect[node_id].tolist()
+            "source": source.get(node_id, []),
+            "effect": effect.get(node_id, [])
         }
     } for node_id, cluster_id in name_to_cluster.items() ]
 
     # Flask side – when you build edges
+    # one cluster lookup per endpoint; None = node outside the top clusters
+    cluster_of = name_to_cluster.get
     edges = []
     for row in interactions:
         a, b = row["stringId_A"], row["stringId_B"]
-        if a not in name_to_cluster or b not in name_to_cluster:
+        cluster_a, cluster_b = cluster_of(a), cluster_of(b)
+        if cluster_a is None or cluster_b is None:
             continue
-        intra = name_to_cluster[a] == name_to_cluster[b]
         edges.append({
             "data": {
                 "source": a,
                 "target": b,
-                "intra": intra
+                "intra": cluster_a == cluster_b
             }
         })
 
-    return jsonify({'nodes': nodes, 'edges': edges, 'enrichment': enrichment})
+    # graph payloads can be megabytes: serialize with orjson (NumPy-aware)
+    return Response(
+        orjson.dumps(
+            {'nodes': nodes, 'edges': edges, 'enrichment': enrichment},
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        ),
+        mimetype='application/json',
+    )
 
 
 @app.route('/api/node-details/<node_id>')